@@ -0,0 +1,558 @@
+import json
+from datetime import datetime
+from difflib import SequenceMatcher
+import hashlib
+import os
+import re
+import unicodedata
+
+BUILD_FOLDER = "/catalog_build_output"
+STATE_FOLDER = f"{BUILD_FOLDER}/state"
+MANIFEST_FILE = f"{STATE_FOLDER}/manifest.json"
+
+# Bump when any merge rule below changes so cached stages are rebuilt
+BUILD_RULES_VERSION = 3
+
+# Retailers in precedence order; earlier sources own the product title
+SOURCE_PRECEDENCE = ["sephora", "ulta", "bluemercury", "nordstrom", "target", "amazon"]
+NOISY_SOURCES = {"amazon"}
+
+# Same-brand titles must be near-identical to merge; one title contained in
+# the other only counts for noisy sources or when the shade sets agree
+TITLE_MATCH_THRESHOLD = 0.9
+TITLE_CONTAINMENT_MIN_WORDS = 3
+
+# Brand / product / shade weights for the reported match_scores['overall'];
+# reporting only, matching is decided by the title rules above
+OVERALL_SCORE_WEIGHTS = (0.52, 0.43, 0.05)
+
+SHADE_FILLER_WORDS = {"shade", "shades", "color", "colour", "no", "number", "tone"}
+SHADE_NOISE_PATTERNS = [
+    r'\b\d+(\.\d+)?\s*(fl\.?\s*oz|oz|ounce|ml|gram|grams)\b',
+    r'\b(pack|count|pk|set) of \d+\b',
+    r'\b\d+\s*(pack|count|pk|pcs|piece|pieces)\b',
+    r'^(n/?a|none|default|assorted|multi|multicolou?r|variety|as shown|see description)$',
+]
+
+MERGED_FROM_RULES = {
+    "product_title_rule": "keep base product_line when matched; do not edit titles (amazon titles are lower quality)",
+    "brand_rule": "choose more descriptive (letters+digits beats letters-only or digits-only; else longer)",
+    "shade_rule_for_trumping": "compare deterministic shade groups (num+name order-insensitive; descriptor-only collapsed) to determine Ulta uniqueness; no fuzzy shades",
+    "shade_display_rule": "for overlapping shades, keep more comprehensive display (alpha+digit preferred) even if Ulta adds no new shade groups",
+    "amazon_extra_rule": "filter obvious non-shade noise in Amazon before merging; no fuzzy shade matching"
+}
+
+def strip_accents(value):
+    """Lowercase and drop accents ('L'Oréal' -> 'l'oreal')"""
+    value = unicodedata.normalize('NFKD', str(value or ""))
+    return "".join(c for c in value if not unicodedata.combining(c)).lower()
+
+def normalize_brand(brand):
+    """Normalize brand to an accent/case/punctuation-insensitive key"""
+    if not brand:
+        return ""
+    return re.sub(r'[^a-z0-9]', '', strip_accents(brand))
+
+def normalize_product_line(product_line, brand=""):
+    """Normalize product line for fuzzy comparison (drops brand prefix and sizes)"""
+    pl = re.sub(SHADE_NOISE_PATTERNS[0], ' ', strip_accents(product_line))
+    tokens = re.findall(r'[a-z0-9]+', pl)
+    # Strip the brand only as whole leading words ('Tarte' must not eat 'Tartelette')
+    brand_tokens = re.findall(r'[a-z0-9]+', strip_accents(brand))
+    if brand_tokens and tokens[:len(brand_tokens)] == brand_tokens:
+        tokens = tokens[len(brand_tokens):]
+    return " ".join(tokens)
+
+def shade_group(shade):
+    """Deterministic shade group: number and name tokens, order-insensitive.
+
+    'Porcelain 1W1', '1W1 Porcelain' and '#1w1 porcelain' share a group.
+    Filler words ('shade', 'no.') are dropped; a shade that is only filler
+    words collapses to those words so it is not lost.
+    """
+    if not shade:
+        return ""
+    shade_str = re.sub(r'\bno\.', ' ', strip_accents(shade)).replace("#", " ")
+    tokens = [t.strip('.') for t in re.findall(r'[a-z0-9.]+', shade_str)]
+    tokens = [t for t in tokens if t]
+    # Drop leading zeros on pure numbers so '05' and '5' group together
+    tokens = [(t.lstrip('0') or '0') if t.isdigit() else t for t in tokens]
+    kept = [t for t in tokens if t not in SHADE_FILLER_WORDS]
+    return " ".join(sorted(kept or tokens))
+
+def shade_signature(shades):
+    """Hash of a product's shade-group set, used as an index key ("" when it has no shades)"""
+    groups = sorted({shade_group(s) for s in shades} - {""})
+    if not groups:
+        return ""
+    return hashlib.sha1("|".join(groups).encode('utf-8')).hexdigest()
+
+def is_noise_shade(shade):
+    """Check if a shade value is obviously not a shade (sizes, pack counts...)"""
+    shade_str = str(shade or "").strip()
+    if not shade_str or len(shade_str) > 60:
+        return True
+    if not re.search(r'[A-Za-z0-9]', shade_str):
+        return True
+    return any(re.search(p, shade_str.lower()) for p in SHADE_NOISE_PATTERNS)
+
+def display_rank(value):
+    """Rank a display string: letters+digits beats letters-only or digits-only, then longer"""
+    value = str(value or "")
+    has_alpha = bool(re.search(r'[A-Za-z]', value))
+    has_digit = bool(re.search(r'\d', value))
+    return (has_alpha and has_digit, len(value))
+
+def file_sha256(path):
+    """Content hash of a source file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_source_file(label, path):
+    """Load one retailer scrape file into catalog-shaped products.
+
+    Accepts either a list of products or a dict with a 'products' list;
+    each product needs a brand (product_line may be blank, as in the catalog).
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        raw = json.load(f)
+    raw_products = raw.get('products', []) if isinstance(raw, dict) else raw
+
+    products = []
+    noise_removed = 0
+    for p in raw_products:
+        brand = str(p.get('brand') or "").strip()
+        product_line = str(p.get('product_line') or "").strip()
+        if not brand:
+            continue
+
+        shades = []
+        seen = set()
+        for shade in p.get('shades') or []:
+            shade = str(shade).strip()
+            if label in NOISY_SOURCES and is_noise_shade(shade):
+                noise_removed += 1
+                continue
+            if shade and shade not in seen:
+                seen.add(shade)
+                shades.append(shade)
+
+        products.append({
+            'brand': brand,
+            'product_line': product_line,
+            'shades': shades,
+            'shades_count_raw': len(p.get('shades') or [])
+        })
+
+    return products, noise_removed
+
+def title_match_score(existing, incoming, allow_containment=False):
+    """Score how confidently two product lines of the same brand are the same product.
+
+    1.0 for identical normalized titles, or (when allow_containment) when
+    every word of the shorter title (at least TITLE_CONTAINMENT_MIN_WORDS
+    words) appears in the longer one; otherwise the SequenceMatcher ratio.
+    """
+    a = normalize_product_line(existing['product_line'], existing['brand'])
+    b = normalize_product_line(incoming['product_line'], incoming['brand'])
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    shorter, longer = sorted((set(a.split()), set(b.split())), key=len)
+    if allow_containment and len(shorter) >= TITLE_CONTAINMENT_MIN_WORDS and shorter <= longer:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+class CatalogIndex:
+    """Hash indexes over merged products.
+
+    by_product_line: (brand key, normalized product line) -> product indexes
+    by_signature: (brand key, shade signature) -> product indexes (products with shades only)
+    by_brand: brand key -> product indexes
+    """
+
+    def __init__(self, products=None):
+        self.products = []
+        self.by_brand = {}
+        self.by_product_line = {}
+        self.by_signature = {}
+        for p in products or []:
+            self.add(p)
+
+    def add(self, product):
+        idx = len(self.products)
+        self.products.append(product)
+        brand_key = normalize_brand(product['brand'])
+        self.by_brand.setdefault(brand_key, []).append(idx)
+        pl_key = normalize_product_line(product['product_line'], product['brand'])
+        self.by_product_line.setdefault((brand_key, pl_key), []).append(idx)
+        if shade_signature(product['shades']):
+            self.by_signature.setdefault((brand_key, shade_signature(product['shades'])), []).append(idx)
+        return idx
+
+    def reindex_shades(self, idx, old_signature):
+        """Move a product to its new signature bucket after its shades changed"""
+        product = self.products[idx]
+        brand_key = normalize_brand(product['brand'])
+        old_bucket = self.by_signature.get((brand_key, old_signature), [])
+        if idx in old_bucket:
+            old_bucket.remove(idx)
+        new_signature = shade_signature(product['shades'])
+        if new_signature:
+            self.by_signature.setdefault((brand_key, new_signature), []).append(idx)
+
+    def match_scores(self, idx, incoming, allow_containment=False):
+        """Brand / product / shade-overlap / overall scores between an indexed and an incoming product"""
+        existing = self.products[idx]
+        brand_score = SequenceMatcher(None, strip_accents(existing['brand']), strip_accents(incoming['brand'])).ratio()
+        product_score = title_match_score(existing, incoming, allow_containment)
+
+        groups_a = {shade_group(s) for s in existing['shades']} - {""}
+        groups_b = {shade_group(s) for s in incoming['shades']} - {""}
+        union = groups_a | groups_b
+        jaccard = len(groups_a & groups_b) / len(union) if union else 0.0
+
+        brand_w, product_w, shade_w = OVERALL_SCORE_WEIGHTS
+        overall = brand_w * brand_score + product_w * product_score + shade_w * jaccard
+        return {
+            'brand': round(brand_score, 3),
+            'product': round(product_score, 3),
+            'shade_jaccard': round(jaccard, 3),
+            'overall': round(overall, 3)
+        }
+
+    def find_match(self, incoming, noisy=False, claimed=()):
+        """Find the existing product for an incoming one, or (None, None).
+
+        An exact normalized product line wins; otherwise the best title in the
+        brand bucket must reach TITLE_MATCH_THRESHOLD. Title containment only
+        counts for noisy sources or candidates with the same shade signature,
+        and shared shades alone never cause a merge. Indexes in `claimed`
+        (already matched in this stage) are skipped.
+        """
+        brand_key = normalize_brand(incoming['brand'])
+        candidates = [idx for idx in self.by_brand.get(brand_key, []) if idx not in claimed]
+        if not candidates:
+            return None, None
+
+        pl_key = normalize_product_line(incoming['product_line'], incoming['brand'])
+        exact = [idx for idx in self.by_product_line.get((brand_key, pl_key), []) if idx not in claimed]
+        signature = shade_signature(incoming['shades'])
+        same_shades = set(self.by_signature.get((brand_key, signature), [])) if signature else set()
+
+        best_idx, best_scores, best_rank = None, None, None
+        for idx in exact or candidates:
+            scores = self.match_scores(idx, incoming, allow_containment=noisy or idx in same_shades)
+            rank = (scores['product'], idx in same_shades, scores['shade_jaccard'])
+            if best_rank is None or rank > best_rank:
+                best_idx, best_scores, best_rank = idx, scores, rank
+
+        if exact or best_scores['product'] >= TITLE_MATCH_THRESHOLD:
+            return best_idx, best_scores
+        return None, None
+
+def merge_source(products, label, source_products, noise_removed, prior_labels):
+    """Merge one retailer's products into the merged list, applying precedence rules.
+
+    prior_labels are the sources merged in earlier stages. Incoming products
+    are only matched against those stages' products, each at most once per
+    stage; unmatched products are added after the loop so this source's own
+    distinct product lines never merge into each other.
+
+    Naming follows the catalog: with a single earlier source the decision
+    and keys use its name ('sephora_trumped_ulta_no_unique_shades'),
+    otherwise 'base' with a label listing the sources merged so far.
+    """
+    index = CatalogIndex(products)
+    new_products = []
+    claimed = set()
+    counts = {}
+    base_key = prior_labels[0] if len(prior_labels) == 1 else "base"
+    base_label = "_".join(prior_labels)
+
+    for incoming in source_products:
+        idx, scores = index.find_match(incoming, noisy=label in NOISY_SOURCES, claimed=claimed)
+
+        if idx is None:
+            decision = f"{label}_only" if prior_labels else f"{label}_only_init"
+            sources = {'decision': decision}
+            if label in NOISY_SOURCES:
+                sources['note'] = f"{label} shades filtered for noise"
+            new_products.append({
+                'brand': incoming['brand'],
+                'product_line': incoming['product_line'],
+                'shades': list(incoming['shades']),
+                'sources': sources
+            })
+            counts[decision] = counts.get(decision, 0) + 1
+            continue
+
+        claimed.add(idx)
+        existing = index.products[idx]
+        old_signature = shade_signature(existing['shades'])
+
+        # Brand: keep the more descriptive spelling; product title never changes
+        if display_rank(incoming['brand']) > display_rank(existing['brand']):
+            existing['brand'] = incoming['brand']
+
+        # Shades: add unique groups, upgrade display for overlapping groups
+        group_positions = {shade_group(s): i for i, s in enumerate(existing['shades'])}
+        unique_groups = 0
+        display_upgraded = False
+        for shade in incoming['shades']:
+            group = shade_group(shade)
+            if not group:
+                continue
+            if group in group_positions:
+                pos = group_positions[group]
+                if display_rank(shade) > display_rank(existing['shades'][pos]):
+                    existing['shades'][pos] = shade
+                    display_upgraded = True
+            else:
+                group_positions[group] = len(existing['shades'])
+                existing['shades'].append(shade)
+                unique_groups += 1
+
+        if unique_groups:
+            decision = f"merged_shades_{label}_added_unique"
+        else:
+            decision = f"{base_key}_trumped_{label}_no_unique_shades"
+
+        diff = {f'{label}_unique_shade_groups': unique_groups}
+        if label in NOISY_SOURCES:
+            diff[f'{label}_noise_removed'] = noise_removed
+        notes = []
+        if label in NOISY_SOURCES:
+            notes.append(f"{label.capitalize()} shades filtered for noise")
+        if display_upgraded:
+            notes.append("overlapping shade display upgraded to more comprehensive (alpha+digit) when available")
+
+        base_info = {
+            'brand': existing['brand'],
+            'product_line': existing['product_line'],
+            'shades_count': len(group_positions) - unique_groups
+        }
+        if base_key == "base":
+            base_info = {'label': base_label, **base_info}
+
+        existing['sources'] = {
+            'decision': decision,
+            base_key: base_info,
+            label: {
+                'brand': incoming['brand'],
+                'product_line': incoming['product_line'],
+                'shades_count_raw': incoming['shades_count_raw'],
+                'shades_count_after_filter': len(incoming['shades'])
+            },
+            'diff': diff,
+            'match_scores': scores
+        }
+        if notes:
+            existing['sources']['note'] = "; ".join(notes)
+
+        index.reindex_shades(idx, old_signature)
+        counts[decision] = counts.get(decision, 0) + 1
+
+    return index.products + new_products, counts
+
+def product_key(product):
+    """Key used to compare catalog products between builds"""
+    return (normalize_brand(product['brand']), normalize_product_line(product['product_line'], product['brand']))
+
+def diff_catalogs(old_products, new_products):
+    """Summarize products added, removed and with changed shade groups.
+
+    Products are grouped by key as lists, so catalogs with several products
+    under the same normalized brand + product line are counted per product.
+    """
+    old_by_key = {}
+    for p in old_products:
+        old_by_key.setdefault(product_key(p), []).append(p)
+    new_by_key = {}
+    for p in new_products:
+        new_by_key.setdefault(product_key(p), []).append(p)
+
+    def groups_of(product):
+        return frozenset({shade_group(s) for s in product['shades']} - {""})
+
+    added = []
+    removed = []
+    shades_changed = []
+    for key in new_by_key.keys() | old_by_key.keys():
+        olds = old_by_key.get(key, [])
+        news = new_by_key.get(key, [])
+        added.extend(news[len(olds):])
+        removed.extend(olds[len(news):])
+
+        # Pair products under the same key, preferring identical shade groups
+        unpaired_old = [groups_of(p) for p in olds[:len(news)]]
+        changed = []
+        for p in news[:len(olds)]:
+            groups = groups_of(p)
+            if groups in unpaired_old:
+                unpaired_old.remove(groups)
+            else:
+                changed.append((p, groups))
+        for (p, new_groups), old_groups in zip(changed, unpaired_old):
+            shades_changed.append({
+                'brand': p['brand'],
+                'product_line': p['product_line'],
+                'shade_groups_added': len(new_groups - old_groups),
+                'shade_groups_removed': len(old_groups - new_groups)
+            })
+
+    return {
+        'added': len(added),
+        'removed': len(removed),
+        'shades_changed': len(shades_changed),
+        'unchanged': len(new_products) - len(added) - len(shades_changed),
+        'added_products': [{'brand': p['brand'], 'product_line': p['product_line']} for p in added],
+        'removed_products': [{'brand': p['brand'], 'product_line': p['product_line']} for p in removed],
+        'shades_changed_products': shades_changed
+    }
+
+def load_manifest():
+    """Load the build manifest from the previous run"""
+    if os.path.exists(MANIFEST_FILE):
+        with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('rules_version') == BUILD_RULES_VERSION:
+            return manifest
+        print("Merge rules changed since last build - rebuilding all sources")
+    return {'stages': []}
+
+def save_json(path, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+
+def build_catalog(source_files, previous_catalog_file=None):
+    """Build the merged catalog from per-retailer scrape files, reusing cached stages.
+
+    source_files maps retailer label -> scrape file. Sources are merged in
+    SOURCE_PRECEDENCE order (unknown labels go last, alphabetically). Each
+    merge stage is cached by the content hashes of its source and every
+    source before it, so only the first changed source onward is reprocessed.
+    """
+    os.makedirs(STATE_FOLDER, exist_ok=True)
+
+    order = [label for label in SOURCE_PRECEDENCE if label in source_files]
+    order += sorted(label for label in source_files if label not in SOURCE_PRECEDENCE)
+
+    print("📂 Hashing source files...")
+    hashes = {label: file_sha256(source_files[label]) for label in order}
+
+    manifest = load_manifest()
+    cached_stages = manifest.get('stages', [])
+
+    # Find how many leading stages are unchanged
+    reusable = 0
+    for label, stage in zip(order, cached_stages):
+        if stage['label'] != label or stage['sha256'] != hashes[label] or not os.path.exists(stage['snapshot']):
+            break
+        reusable += 1
+
+    products = []
+    stages = cached_stages[:reusable]
+    if reusable:
+        with open(stages[-1]['snapshot'], 'r', encoding='utf-8') as f:
+            products = json.load(f)
+        print(f"✅ Reusing {reusable} cached stage(s): {', '.join(order[:reusable])}")
+
+    reprocessed = order[reusable:]
+    print(f"Will reprocess {len(reprocessed)} of {len(order)} sources\n")
+
+    for i, label in enumerate(reprocessed, start=reusable):
+        print(f"🔄 Merging {label}...")
+        source_products, noise_removed = load_source_file(label, source_files[label])
+        products, counts = merge_source(products, label, source_products, noise_removed, prior_labels=order[:i])
+
+        snapshot = f"{STATE_FOLDER}/stage_{i:02d}_{label}.json"
+        save_json(snapshot, products)
+        stages.append({'label': label, 'sha256': hashes[label], 'snapshot': snapshot, 'counts': counts})
+        print(f"   {len(source_products)} products in, {len(products)} merged so far"
+              + (f" ({noise_removed} noise shades removed)" if noise_removed else ""))
+
+    output_products = [
+        {'brand': p['brand'], 'product_line': p['product_line'], 'shades': p['shades'], 'sources': p['sources']}
+        for p in products
+    ]
+    output_products.sort(key=lambda p: (p['brand'].casefold(), p['product_line'].casefold()))
+
+    # Later stages overwrite sources.decision, so count decisions on the final products
+    summary = {}
+    for p in output_products:
+        decision = p['sources'].get('decision')
+        summary[decision] = summary.get(decision, 0) + 1
+
+    catalog = {
+        'generated_at': datetime.now().isoformat(),
+        'merged_from': {
+            'source_files': {label: os.path.basename(source_files[label]) for label in order},
+            'precedence': order,
+            **MERGED_FROM_RULES
+        },
+        'summary': dict(sorted(summary.items())),
+        'products': output_products
+    }
+
+    # Diff against the explicit previous catalog, else the last build's output;
+    # read it before writing, since a build in the same second reuses the file name
+    previous_catalog_file = previous_catalog_file or manifest.get('output_file')
+    previous_products = []
+    if previous_catalog_file and os.path.exists(previous_catalog_file):
+        with open(previous_catalog_file, 'r', encoding='utf-8') as f:
+            previous_products = json.load(f).get('products', [])
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_file = f"{BUILD_FOLDER}/merged_catalog_{timestamp}.json"
+    diff_file = f"{BUILD_FOLDER}/catalog_diff_{timestamp}.json"
+    save_json(output_file, catalog)
+
+    diff = {
+        'previous_catalog': previous_catalog_file,
+        'reused_sources': order[:reusable],
+        'reprocessed_sources': reprocessed,
+        **diff_catalogs(previous_products, output_products)
+    }
+    save_json(diff_file, diff)
+
+    save_json(MANIFEST_FILE, {
+        'rules_version': BUILD_RULES_VERSION,
+        'stages': stages,
+        'output_file': output_file,
+        'last_updated': datetime.now().isoformat()
+    })
+
+    print()
+    print("📊 Build Summary:")
+    print(f"   Products: {len(output_products)}")
+    for decision, count in catalog['summary'].items():
+        print(f"   {decision}: {count}")
+    print()
+    print("🔍 Diff vs previous catalog:")
+    print(f"   Added: {diff['added']}")
+    print(f"   Removed: {diff['removed']}")
+    print(f"   Shades changed: {diff['shades_changed']}")
+    print(f"   Unchanged: {diff['unchanged']}")
+    print(f"\n📁 Saved catalog to: {output_file}")
+    print(f"📁 Saved diff to: {diff_file}")
+
+    return catalog, diff
+
+if __name__ == "__main__":
+    # Update these paths; one scrape file per retailer
+    source_files = {
+        "sephora": "sephora scrape file",
+        "ulta": "ulta scrape file",
+        "bluemercury": "bluemercury scrape file",
+        "nordstrom": "nordstrom scrape file",
+        "target": "target scrape file",
+        "amazon": "amazon scrape file",
+    }
+    previous_catalog_file = "Product_Catalogue_normalized_merged_catalog_sorted_Feb10_deduped_sameformat.json"
+
+    build_catalog(source_files, previous_catalog_file)
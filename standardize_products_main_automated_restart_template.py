@@ -38,7 +38,81 @@ def extract_shade_number(shade):
         return match.group()
     return None
 
-def ai_match_product(raw_product, brand, raw_shade, catalog):
+MATCH_INSTRUCTIONS = """You are matching beauty product names. Given a raw product name, find the best match from the catalog.
+
+Rules:
+- "yummy skin" matches "Yummy Skin Soothing Serum Skin Tint Foundation..."
+- "Gel Grip Gel" matches "Hydro Grip 12-Hour Hydrating Gel Skin Tint"
+- Shortened product names match full product names
+- Focus on key identifying words
+- Return the EXACT product name from the catalog list (case-sensitive, use exact spelling)
+- If a shade-matched shortlist is given, pick from that shortlist only
+- Only return "NONE" if there's truly no reasonable match
+
+Answer with just the exact product name or NONE."""
+
+def find_shade_matched_products(products_list, raw_shade):
+    """Return product lines whose shades match the raw shade (by name or number)"""
+    if not raw_shade or raw_shade == "":
+        return []
+    
+    raw_normalized = normalize_shade(raw_shade)
+    raw_number = extract_shade_number(raw_normalized)
+    
+    valid_products = []
+    for p in products_list:
+        for shade in p['shades']:
+            shade_normalized = normalize_shade(shade)
+            shade_number = extract_shade_number(shade_normalized)
+            
+            # Check if shade matches
+            if shade_normalized.lower() == raw_normalized.lower():
+                valid_products.append(p['product_line'])
+                break
+            # Or if numbers match
+            elif raw_number and shade_number and raw_number == shade_number:
+                valid_products.append(p['product_line'])
+                break
+    
+    return valid_products
+
+def build_match_messages(raw_product, brand, raw_shade, products_list, shade_matched):
+    """Build chat messages with a stable prefix for provider-side prompt caching.
+    
+    Static instructions and the brand's full catalog list come first and are
+    identical for every item of the same brand; per-item fields go last.
+    """
+    brand_block = f"""Brand: "{brand}"
+
+Catalog products for this brand:
+{chr(10).join(p['product_line'] for p in products_list)}"""
+    
+    item_block = f'Raw product: "{raw_product}"'
+    if raw_shade:
+        item_block += f'\nRaw shade: "{raw_shade}"'
+    if shade_matched:
+        item_block += f"""
+
+Shade-matched shortlist:
+{chr(10).join(shade_matched)}"""
+    
+    return [
+        {"role": "system", "content": MATCH_INSTRUCTIONS},
+        {"role": "user", "content": f"{brand_block}\n\n{item_block}"}
+    ]
+
+def record_usage(usage_stats, usage):
+    """Accumulate token usage (including cached prompt tokens) from a response"""
+    if usage_stats is None or usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached = getattr(details, 'cached_tokens', 0) if details else 0
+    usage_stats['requests'] = usage_stats.get('requests', 0) + 1
+    usage_stats['prompt_tokens'] = usage_stats.get('prompt_tokens', 0) + (usage.prompt_tokens or 0)
+    usage_stats['cached_tokens'] = usage_stats.get('cached_tokens', 0) + (cached or 0)
+    usage_stats['completion_tokens'] = usage_stats.get('completion_tokens', 0) + (usage.completion_tokens or 0)
+
+def ai_match_product(raw_product, brand, raw_shade, catalog, usage_stats=None):
     """Use OpenAI to match product line to catalog, validate with shade"""
     if not raw_product or raw_product == "" or not brand:
         if not brand:
@@ -51,68 +125,38 @@ def ai_match_product(raw_product, brand, raw_shade, catalog):
     if not products_list:
         return None, 0, "brand_has_no_products"
     
-    # If we have a shade, filter products that have this shade
-    if raw_shade and raw_shade != "":
-        raw_normalized = normalize_shade(raw_shade)
-        raw_number = extract_shade_number(raw_normalized)
-        
-        # Find products that have matching shades
-        valid_products = []
-        for p in products_list:
-            for shade in p['shades']:
-                shade_normalized = normalize_shade(shade)
-                shade_number = extract_shade_number(shade_normalized)
-                
-                # Check if shade matches
-                if shade_normalized.lower() == raw_normalized.lower():
-                    valid_products.append(p['product_line'])
-                    break
-                # Or if numbers match
-                elif raw_number and shade_number and raw_number == shade_number:
-                    valid_products.append(p['product_line'])
-                    break
-        
-        # If we found products with matching shades, use only those
-        if valid_products:
-            products_to_match = valid_products
-        else:
-            # No shade match, use all products
-            products_to_match = [p['product_line'] for p in products_list]
+    # If we found products with matching shades, use only those
+    # (the full brand list still goes in the prompt prefix for caching)
+    shade_matched = find_shade_matched_products(products_list, raw_shade)
+    if shade_matched:
+        products_to_match = shade_matched
     else:
+        # No shade match, use all products
         products_to_match = [p['product_line'] for p in products_list]
+    all_products = [p['product_line'] for p in products_list]
     
-    prompt = f"""You are matching beauty product names. Given a raw product name, find the best match from the catalog.
-
-Raw product: "{raw_product}"
-Brand: "{brand}"
-
-Match to one of these products (case-sensitive, use exact spelling):
-{chr(10).join(products_to_match)}
-
-Rules:
-- "yummy skin" matches "Yummy Skin Soothing Serum Skin Tint Foundation..."
-- "Gel Grip Gel" matches "Hydro Grip 12-Hour Hydrating Gel Skin Tint"
-- Shortened product names match full product names
-- Focus on key identifying words
-- Return the EXACT product name from the list above
-- Only return "NONE" if there's truly no reasonable match
-
-Answer with just the exact product name or NONE:"""
+    messages = build_match_messages(raw_product, brand, raw_shade, products_list, shade_matched)
     
     try:
         response = client.chat.completions.create(
             model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
+            messages=messages,
             temperature=0
         )
         
         time.sleep(0.1)
         
+        record_usage(usage_stats, getattr(response, 'usage', None))
+        
         match = response.choices[0].message.content.strip()
         
         if match == "NONE":
             return None, 0, "ai_returned_none"
         
+        # Real catalog product, but not one whose shades match - rejected, tracked separately
+        if match not in products_to_match and match in all_products:
+            return None, 0, "ai_outside_shade_shortlist"
+        
         if match not in products_to_match:
             return None, 0, "ai_hallucinated"
         
@@ -147,6 +191,7 @@ def standardize_products(data_file, catalog_file):
     standardized = []
     output_file = None
     non_match_file = None
+    usage_stats = {}
     
     if os.path.exists(CHECKPOINT_FILE):
         print(f"Found checkpoint file - loading previous progress...")
@@ -157,6 +202,7 @@ def standardize_products(data_file, catalog_file):
             output_files = checkpoint.get('output_files', {})
             output_file = output_files.get('standardized')
             non_match_file = output_files.get('non_matches')
+            usage_stats = checkpoint.get('usage', {})
             
             # Load existing data
             if output_file and os.path.exists(output_file):
@@ -178,6 +224,11 @@ def standardize_products(data_file, catalog_file):
     # Filter out already processed items
     items_to_process = [item for item in data if get_item_key(item) not in processed_keys]
     
+    # Process brand by brand so consecutive requests share the same prompt prefix;
+    # outputs are written back in input order
+    items_to_process.sort(key=lambda item: item.get('brand_standardized') or '')
+    input_position = {get_item_key(item): pos for pos, item in enumerate(data)}
+    
     print(f"Will process {len(items_to_process)} new items out of {len(data)} total\n")
     
     if len(items_to_process) == 0:
@@ -192,6 +243,9 @@ def standardize_products(data_file, catalog_file):
     
     def save_all_files():
         """Save all output files immediately"""
+        # Keep input order regardless of the brand-grouped processing order
+        standardized.sort(key=lambda item: input_position.get(get_item_key(item), len(data)))
+        
         # Save standardized items
         with open(output_file, 'w', encoding='utf-8') as f:
             json.dump(standardized, f, indent=2, ensure_ascii=False)
@@ -230,6 +284,7 @@ def standardize_products(data_file, catalog_file):
                 'standardized': output_file,
                 'non_matches': non_match_file
             },
+            'usage': usage_stats,
             'last_updated': datetime.now().isoformat()
         }
         with open(CHECKPOINT_FILE, 'w', encoding='utf-8') as f:
@@ -248,7 +303,7 @@ def standardize_products(data_file, catalog_file):
         # Only match product if we have a brand
         if brand_match and raw_product:
             try:
-                product_match, product_score, match_status = ai_match_product(raw_product, brand_match, raw_shade, catalog)
+                product_match, product_score, match_status = ai_match_product(raw_product, brand_match, raw_shade, catalog, usage_stats)
                 ai_calls += 1
             except Exception as e:
                 print(f"   ⚠️  Error on product '{raw_product}': {e}")
@@ -290,6 +345,18 @@ def standardize_products(data_file, catalog_file):
     print(f"   Errors encountered: {errors}")
     print(f"   Skipped (no brand): {skipped}")
     print(f"   Product matches: {product_matches}/{items_with_brands} items with brands ({round(product_matches/items_with_brands*100) if items_with_brands else 0}%)")
+    rejected_outside_shortlist = sum(1 for item in standardized if item.get('product_match_status') == 'ai_outside_shade_shortlist')
+    print(f"   Rejected (outside shade shortlist): {rejected_outside_shortlist}")
+    
+    prompt_tokens = usage_stats.get('prompt_tokens', 0)
+    cached_tokens = usage_stats.get('cached_tokens', 0)
+    print()
+    print("📊 Token usage (cumulative across restarts):")
+    print(f"   API requests: {usage_stats.get('requests', 0)}")
+    print(f"   Prompt tokens: {prompt_tokens} (cached: {cached_tokens}, {round(cached_tokens/prompt_tokens*100) if prompt_tokens else 0}%)")
+    print(f"   Completion tokens: {usage_stats.get('completion_tokens', 0)}")
+    print("   Note: OpenAI prefix caching only applies once the prompt prefix reaches 1024 tokens,")
+    print("   so brands with small catalogs will show 0 cached tokens.")
     
     # Collect unique non-matches with reasons
     non_match_products = {}
@@ -308,7 +375,8 @@ def standardize_products(data_file, catalog_file):
         # Group by status
         not_in_catalog = [(brand, prod, shade, count) for (brand, prod, shade, status), count in non_match_products.items() if status == 'ai_returned_none']
         hallucinated = [(brand, prod, shade, count) for (brand, prod, shade, status), count in non_match_products.items() if status == 'ai_hallucinated']
-        other = [(brand, prod, shade, count) for (brand, prod, shade, status), count in non_match_products.items() if status not in ['ai_returned_none', 'ai_hallucinated']]
+        outside_shortlist = [(brand, prod, shade, count) for (brand, prod, shade, status), count in non_match_products.items() if status == 'ai_outside_shade_shortlist']
+        other = [(brand, prod, shade, count) for (brand, prod, shade, status), count in non_match_products.items() if status not in ['ai_returned_none', 'ai_hallucinated', 'ai_outside_shade_shortlist']]
         
         print()
         print(f"🔍 Products not found ({len(non_match_products)} unique):")
@@ -325,6 +393,12 @@ def standardize_products(data_file, catalog_file):
                 shade_info = f" | Shade: {shade}" if shade else ""
                 print(f"      {brand} | {prod}{shade_info} ({count}x)")
         
+        if outside_shortlist:
+            print(f"\n   OUTSIDE SHADE SHORTLIST ({len(outside_shortlist)}):")
+            for brand, prod, shade, count in sorted(outside_shortlist, key=lambda x: x[3], reverse=True)[:10]:
+                shade_info = f" | Shade: {shade}" if shade else ""
+                print(f"      {brand} | {prod}{shade_info} ({count}x)")
+        
         if other:
             print(f"\n   OTHER ERRORS ({len(other)}):")
             for brand, prod, shade, count in sorted(other, key=lambda x: x[3], reverse=True)[:10]: